@@ -1,27 +1,100 @@
 from flask import Flask, request, jsonify
+import numpy as np
 import pandas as pd
 import firebase_admin
 from firebase_admin import credentials, firestore, storage
+from google.api_core import exceptions as gcp_exceptions, retry as gcp_retry
 import requests
-from io import BytesIO
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from tempfile import SpooledTemporaryFile
+import shutil
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+import threading
+import queue
+import time
+from cachetools import TTLCache
 import re
-from datetime import timezone
+import json
 import os
 from dotenv import load_dotenv
 
 load_dotenv()
-encoded_credentials = os.getenv("GOOGLE_APPLICATION_CREDENTIALS")
 
-decoded_credentials = None
-if encoded_credentials:
-    import base64
-    decoded_credentials = base64.b64decode(encoded_credentials).decode('utf-8')
-    with open("firebase_creds.json", "w") as f:
-        f.write(decoded_credentials)
+# Function to initialize Firebase once per process
+def initialize_firebase():
+    if firebase_admin._apps:
+        return
 
-cred = credentials.Certificate("firebase_creds.json")
-firebase_admin.initialize_app(cred,{'storageBucket': 'kawach-516a2.firebasestorage.app'})
-db = firestore.client()        
+    encoded_credentials = os.getenv("GOOGLE_APPLICATION_CREDENTIALS")
+    if encoded_credentials:
+        import base64
+        decoded_credentials = base64.b64decode(encoded_credentials).decode('utf-8')
+        cred = credentials.Certificate(json.loads(decoded_credentials))
+    else:
+        # Fall back to a local credentials file for development
+        cred = credentials.Certificate("firebase_creds.json")
+
+    firebase_admin.initialize_app(cred,{'storageBucket': 'kawach-516a2.firebasestorage.app'})
+
+initialize_firebase()
+db = firestore.client()
+
+# Shared HTTP session so Excel downloads reuse pooled connections
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=32,
+    max_retries=Retry(total=3, backoff_factor=0.2, status_forcelist=[502, 503, 504]),
+))
+
+# Worker pool for Firestore lookups that request threads wait on
+EXECUTOR = ThreadPoolExecutor(max_workers=8)
+
+# Separate pool for fire-and-forget Storage deletions so a slow Storage
+# backend can't delay the admin lookups above
+DELETE_EXECUTOR = ThreadPoolExecutor(max_workers=4)
+
+# Retry transient Firestore write failures with exponential backoff
+RETRYABLE_FIRESTORE_ERRORS = (
+    gcp_exceptions.Aborted,
+    gcp_exceptions.DeadlineExceeded,
+    gcp_exceptions.ServiceUnavailable,
+)
+FIRESTORE_WRITE_RETRY = gcp_retry.Retry(
+    predicate=gcp_retry.if_exception_type(*RETRYABLE_FIRESTORE_ERRORS),
+    initial=0.1,
+    maximum=2.0,
+    multiplier=2,
+    timeout=10.0,
+)
+FIRESTORE_RPC_TIMEOUT = 5.0  # Seconds per individual Firestore write attempt
+# Raised once FIRESTORE_WRITE_RETRY gives up (RetryError) or on a transient error
+FIRESTORE_TRANSIENT_FAILURES = (gcp_exceptions.RetryError, *RETRYABLE_FIRESTORE_ERRORS)
+
+# Short-lived cache of admin references per user; these documents rarely change
+ADMIN_REFS_CACHE = TTLCache(maxsize=2048, ttl=60)
+ADMIN_REFS_CACHE_LOCK = threading.Lock()
+
+# Pending data documents, committed together by a background writer thread
+WRITE_QUEUE = queue.Queue()
+# Each worker serves at most GUNICORN_THREADS concurrent requests (see gunicorn.conf.py),
+# so a batch can never hold more documents than that
+WRITE_BATCH_MAX_SIZE = int(os.environ.get("GUNICORN_THREADS", 8))
+WRITE_BATCH_WINDOW = 0.05  # Seconds to wait for other in-flight uploads before committing
+WRITE_RESULT_TIMEOUT = 30.0  # Seconds a request waits for the writer to pick up its document
+write_thread = None
+write_thread_lock = threading.Lock()
+parsed_uploads = 0  # Requests that have parsed their file but not yet queued its document
+parsed_uploads_lock = threading.Lock()
+
+# .xlsx files are ZIP archives; HTML/JSON error pages are rejected before parsing
+XLSX_MAGIC = b"PK\x03\x04"
+NON_EXCEL_CONTENT_TYPES = ("text/", "application/json")
+
+# Patterns for pulling the user ID and the Storage object path out of download URLs
+USER_ID_RE = re.compile(r'/users%2F([^%]+)')
+FILE_PATH_RE = re.compile(r'/o/(.+)\?alt=media')
 
 # Initialize Flask App
 app = Flask(__name__)
@@ -29,7 +102,7 @@ app = Flask(__name__)
 # Function to extract user ID from the URL
 def extract_user_id(file_url):
     try:
-        match = re.search(r'/users%2F([^%]+)', file_url)
+        match = USER_ID_RE.search(file_url)
         if match:
             return match.group(1)
         return None
@@ -56,10 +129,96 @@ def fetch_admin_references(facility_admin_ref):
         print(f"Error fetching admin references: {e}")
         return {}
 
+# Function to fetch admin references for a user ID, served from the cache when fresh
+def fetch_admin_references_by_uid(user_id):
+    with ADMIN_REFS_CACHE_LOCK:
+        cached = ADMIN_REFS_CACHE.get(user_id)
+    if cached is not None:
+        return cached
+
+    admin_references = fetch_admin_references(db.collection("users").document(user_id))
+    if admin_references:  # Don't cache missing documents or failed lookups
+        with ADMIN_REFS_CACHE_LOCK:
+            ADMIN_REFS_CACHE[user_id] = admin_references
+    return admin_references
+
+# Function to commit queued data documents in batches, run by the background writer thread
+def batch_write_worker():
+    while True:
+        pending = [WRITE_QUEUE.get()]
+        flush_at = time.monotonic() + WRITE_BATCH_WINDOW
+        while len(pending) < WRITE_BATCH_MAX_SIZE:
+            try:
+                pending.append(WRITE_QUEUE.get_nowait())
+                continue
+            except queue.Empty:
+                pass
+
+            # Only wait for more documents while a parsed upload is about to queue one
+            remaining = flush_at - time.monotonic()
+            if remaining <= 0 or parsed_uploads == 0:
+                break
+            try:
+                pending.append(WRITE_QUEUE.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        # Drop writes whose request already gave up; the rest can no longer be cancelled
+        pending = [item for item in pending if item[2].set_running_or_notify_cancel()]
+        if not pending:
+            continue
+
+        try:
+            batch = db.batch()
+            for doc_ref, data, _ in pending:
+                batch.set(doc_ref, data)
+            batch.commit(retry=FIRESTORE_WRITE_RETRY, timeout=FIRESTORE_RPC_TIMEOUT)
+        except FIRESTORE_TRANSIENT_FAILURES as e:
+            # Retries are already exhausted, so fail the whole batch rather than stall the writer
+            print(f"Error committing batch of {len(pending)} documents: {e}")
+            for _, _, future in pending:
+                future.set_exception(e)
+        except Exception as e:
+            print(f"Error committing batch of {len(pending)} documents: {e}")
+            # Likely a bad document; write individually, without retries, so it doesn't fail the rest
+            for index, (doc_ref, data, future) in enumerate(pending):
+                try:
+                    doc_ref.set(data, retry=None, timeout=FIRESTORE_RPC_TIMEOUT)
+                    future.set_result(doc_ref)
+                except FIRESTORE_TRANSIENT_FAILURES as write_error:
+                    # Firestore itself is failing; don't keep the writer busy on the rest
+                    for _, _, remaining_future in pending[index:]:
+                        remaining_future.set_exception(write_error)
+                    break
+                except Exception as write_error:
+                    future.set_exception(write_error)
+        else:
+            for doc_ref, _, future in pending:
+                future.set_result(doc_ref)
+
+# Function to adjust the count of parsed uploads that are about to queue a document
+def track_parsed_upload(delta):
+    global parsed_uploads
+    with parsed_uploads_lock:
+        parsed_uploads += delta
+
+# Function to queue a data document for the batch writer, returning a Future for its write
+def queue_document_write(doc_ref, data):
+    global write_thread
+    with write_thread_lock:
+        # Started lazily so each forked gunicorn worker gets its own writer thread
+        if write_thread is None or not write_thread.is_alive():
+            write_thread = threading.Thread(target=batch_write_worker, daemon=True)
+            write_thread.start()
+
+    future = Future()
+    WRITE_QUEUE.put((doc_ref, data, future))
+    return future
+
 # Function to delete a file from Firebase Storage
 def delete_file_from_url(file_url):
     try:
-        match = re.search(r'/o/(.+)\?alt=media', file_url)
+        match = FILE_PATH_RE.search(file_url)
         if not match:
             raise ValueError("Invalid URL format")
         file_path = match.group(1).replace('%2F', '/')
@@ -75,6 +234,7 @@ def delete_file_from_url(file_url):
 
 @app.route('/upload', methods=['POST'])
 def upload_and_delete():
+    awaiting_queue = False
     try:
         # Extract data from the request body
         body = request.json
@@ -84,33 +244,72 @@ def upload_and_delete():
         if not url or not current_month:
             return jsonify({"error": "Missing 'url' or 'currentMonth' in request body"}), 400
 
-        # Download the Excel file from the URL
-        response = requests.get(url)
-        response.raise_for_status()  # Raise an exception for HTTP errors
+        # Extract user ID from the URL and start fetching admin references
+        # while the Excel file is downloaded and parsed
+        user_id = extract_user_id(url)
+        facility_admin_ref = None
+        admin_future = None
+        if user_id:
+            # Create a Firestore reference to the user document
+            facility_admin_ref = db.collection("users").document(user_id)
+            admin_future = EXECUTOR.submit(fetch_admin_references_by_uid, user_id)
+
+        # Download the Excel file from the URL in chunks, spilling to disk for large files
+        with SESSION.get(url, timeout=(5, 30), stream=True) as response, \
+                SpooledTemporaryFile(max_size=4 * 1024 * 1024) as excel_file:
+            response.raise_for_status()  # Raise an exception for HTTP errors
+            if response.headers.get("Content-Type", "").startswith(NON_EXCEL_CONTENT_TYPES):
+                return jsonify({"error": "URL did not return an Excel file"}), 400
 
-        # Load the Excel file into a Pandas DataFrame
-        file_bytes = BytesIO(response.content)
-        df = pd.read_excel(file_bytes)
+            response.raw.decode_content = True  # Undo any gzip/deflate transfer encoding
+            # Decoded reads can come back short, so read until the signature is complete or EOF
+            magic = b""
+            while len(magic) < len(XLSX_MAGIC):
+                chunk = response.raw.read(len(XLSX_MAGIC) - len(magic))
+                if not chunk and response.raw.closed:  # An empty read alone isn't EOF
+                    break
+                magic += chunk
+            if magic != XLSX_MAGIC:
+                return jsonify({"error": "URL did not return an .xlsx file"}), 400
 
-        # Extract the fields and values
-        df.iloc[3:100, 7] = df.iloc[3:100, 7].fillna(0)
+            excel_file.write(magic)
+            shutil.copyfileobj(response.raw, excel_file, 64 * 1024)
+            excel_file.seek(0)
+
+            # Load only Column B (fields) and Column H (values) of the data rows
+            df = pd.read_excel(
+                excel_file,
+                engine="calamine",
+                sheet_name=0,
+                usecols="B,H",
+                skiprows=4,
+                nrows=97,
+                header=None,
+                names=["field", "value"],
+                dtype={"field": str},
+            )
 
         # Extract fields (Column B) and values (Column H)
-        fields = df.iloc[3:100, 1].astype(str).tolist()  # Column B, rows 4 to 100
-        values = df.iloc[3:100, 7].astype(int).tolist()  # Column H, rows 4 to 100
+        try:
+            values = df["value"].to_numpy(dtype=np.float64, na_value=0.0)  # Empty cells become 0
+        except (TypeError, ValueError):
+            return jsonify({"error": "Column H must contain only numeric values"}), 400
+
+        # Let the batch writer know a document for this request is on its way
+        track_parsed_upload(1)
+        awaiting_queue = True
+
+        fields = df["field"].fillna("nan").tolist()  # Blank cells keep their previous "nan" key
+        values = values.astype(np.int64).tolist()
         
         # Combine fields and values into a dictionary
         data = dict(zip(fields, values))
 
-        # Extract user ID from the URL
-        user_id = extract_user_id(url)
         if user_id:
-            # Create a Firestore reference to the user document
-            facility_admin_ref = db.collection("users").document(user_id)
             data["facilityAdminRef"] = facility_admin_ref
 
-            # Fetch additional references
-            admin_references = fetch_admin_references(facility_admin_ref)
+            # Wait for the additional references
+            admin_references = admin_future.result()
             data.update(admin_references)  # Add subDistrictAdminRef, districtAdminRef, stateAdminRef
         else:
             print("Failed to extract user ID from the URL.")
@@ -121,26 +320,37 @@ def upload_and_delete():
         data['timestamp'] = firestore.SERVER_TIMESTAMP  # Use Firestore's server timestamp
 
         # Push data to Firebase
-        doc_ref = db.collection("data").add(data)  # Adds a new document with auto-generated ID
-        document_id = doc_ref[1].id
+        doc_ref = db.collection("data").document()  # Client-generated ID, known before the write
+        write_future = queue_document_write(doc_ref, data)
+        track_parsed_upload(-1)
+        awaiting_queue = False
+        try:
+            # Wait until the batch containing it commits
+            write_future.result(timeout=WRITE_RESULT_TIMEOUT)
+        except FutureTimeoutError:
+            if write_future.cancel():  # Still queued, so it will never be written
+                return jsonify({"error": "Timed out waiting for the Firestore write"}), 504
+            # Already being committed; the writer's RPCs are time-bounded, so wait for the outcome
+            write_future.result()
+        document_id = doc_ref.id
 
-        # Deletion as a follow-up task
-        deletion_status = delete_file_from_url(url)
-        if deletion_status:
-            deletion_message = "File successfully deleted."
-        else:
-            deletion_message = "Failed to delete file."
+        # Deletion as a background follow-up task; failures are logged by delete_file_from_url
+        DELETE_EXECUTOR.submit(delete_file_from_url, url)
 
         return jsonify({
             "message": "Data successfully uploaded",
             "documentId": document_id,
-            "deletionStatus": deletion_message
+            "deletionStatus": "queued"
         }), 200
 
     except Exception as e:
         print(f"Error in /upload endpoint: {e}")
         return jsonify({"error": str(e)}), 500
 
+    finally:
+        if awaiting_queue:
+            track_parsed_upload(-1)
+
 if __name__ == '__main__':
     port = int(os.environ.get("PORT", 5000))  # Use the PORT from the environment, default to 5000
     app.run(host='0.0.0.0', port=port)
@@ -0,0 +1,17 @@
+import os
+
+wsgi_app = "app:app"
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+
+# Threaded workers so Excel downloads and Firestore/Storage calls overlap across requests
+worker_class = "gthread"
+# Match `nproc`: count the CPUs this process may run on, not every CPU on the host
+usable_cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+workers = int(os.environ.get("WEB_CONCURRENCY", usable_cpus))
+threads = int(os.environ.get("GUNICORN_THREADS", 8))
+
+# Import app.py once in the master before forking workers. The Firestore client
+# opens its gRPC channel lazily on the first RPC, so each worker still opens its
+# own; GRPC_ENABLE_FORK_SUPPORT keeps gRPC's internal state fork-safe regardless
+os.environ.setdefault("GRPC_ENABLE_FORK_SUPPORT", "1")
+preload_app = True